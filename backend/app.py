@@ -1,11 +1,25 @@
 import streamlit as st
 import requests
 import json
+from itertools import chain
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List, Dict
 
 # --- Configuration ---
 FASTAPI_URL = "http://127.0.0.1:8000"
 ROLES = ["Product Lead", "Tech Lead", "Compliance Lead", "Bank Alliance Lead"]
+DEFAULT_TIMEOUT = (3, 600)  # (connect, read) seconds; uploads and answers can take minutes on CPU
+
+# --- HTTP Session ---
+# Streamlit reruns the whole script on every interaction; a cached session keeps backend connections warm across reruns.
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2)))
+    return session
+
+SESSION = get_http_session()
 
 # --- State Management ---
 if "messages" not in st.session_state:
@@ -20,7 +34,7 @@ if "past_chats" not in st.session_state:
 # --- API Functions ---
 def get_past_chats():
     try:
-        response = requests.get(f"{FASTAPI_URL}/chats")
+        response = SESSION.get(f"{FASTAPI_URL}/chats", timeout=DEFAULT_TIMEOUT)
         response.raise_for_status()
         st.session_state.past_chats = response.json()
     except requests.exceptions.RequestException:
@@ -29,9 +43,12 @@ def get_past_chats():
 
 def load_chat_history(chat_id: str):
     try:
-        response = requests.get(f"{FASTAPI_URL}/history/{chat_id}")
+        response = SESSION.get(f"{FASTAPI_URL}/history/{chat_id}", timeout=DEFAULT_TIMEOUT)
         response.raise_for_status()
         st.session_state.messages = response.json()
+        for message in st.session_state.messages:
+            if message["role"] == "assistant":
+                message["_sources_md"] = format_sources_md(message.get("sources") or [])
         st.session_state.chat_id = chat_id
         for chat in st.session_state.past_chats:
             if chat['chat_id'] == chat_id:
@@ -42,16 +59,41 @@ def load_chat_history(chat_id: str):
         st.error(f"Failed to load history: {e}")
 
 # --- UI Helper Functions ---
+@st.cache_data
+def format_sources_md(sources: List[Dict]) -> str:
+    lines = []
+    for s in sources:
+        score_info = ""
+        if s.get("doc_type_score") is not None:
+            score_info = f" (Type: *{s.get('doc_type', 'N/A')}* - Confidence: {s['doc_type_score']:.2%})"
+        lines.append(f"- **{s['source_file']}**{score_info}")
+    return "\n".join(lines)
+
+def display_sources(sources_md: str):
+    if sources_md:
+        with st.expander("Sources", expanded=False):
+            st.markdown(sources_md)
+
 def display_assistant_message(message: Dict):
     st.markdown(message["content"])
-
-    if message.get("sources"):
-        with st.expander("Sources", expanded=False):
-            for s in message["sources"]:
-                score_info = ""
-                if s.get("doc_type_score") is not None:
-                    score_info = f" (Type: *{s.get('doc_type', 'N/A')}* - Confidence: {s['doc_type_score']:.2%})"
-                st.markdown(f"- **{s['source_file']}**{score_info}")
+    # Sources markdown is built once when the message is added, not on every rerun.
+    if "_sources_md" not in message:
+        message["_sources_md"] = format_sources_md(message.get("sources") or [])
+    display_sources(message["_sources_md"])
+
+def stream_chat_answer(response: requests.Response, stream_state: Dict):
+    # Yields answer tokens from the server-sent events of /chat/stream; sources and errors land in stream_state.
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data: "):
+            continue
+        event = json.loads(line[len("data: "):])
+        if "token" in event:
+            yield event["token"]
+        elif "sources" in event:
+            stream_state["sources"] = event["sources"]
+        elif "error" in event:
+            stream_state["error"] = event["error"]
 
 # --- Sidebar UI ---
 with st.sidebar:
@@ -82,11 +124,11 @@ with st.sidebar:
         with st.spinner("Processing documents... This may take a moment."):
             try:
                 files_for_upload = [("files", (file.name, file.getvalue(), file.type)) for file in uploaded_files]
-                response = requests.post(
+                response = SESSION.post(
                     f"{FASTAPI_URL}/upload",
                     data={"role": selected_role},
                     files=files_for_upload,
-                    timeout=600
+                    timeout=DEFAULT_TIMEOUT
                 )
                 response.raise_for_status()
                 result = response.json()
@@ -131,26 +173,38 @@ if prompt := st.chat_input("Ask a question..."):
         with st.chat_message("user"): st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                try:
-                    response = requests.post(
-                        f"{FASTAPI_URL}/chat",
-                        json={"chat_id": st.session_state.chat_id, "message": prompt}
+            try:
+                stream_state = {"sources": [], "error": None}
+                # The response headers arrive before routing, retrieval and prefill are done, so the spinner
+                # stays up until the first token and that token is put back in front of the rest.
+                with st.spinner("Thinking..."):
+                    response = SESSION.post(
+                        f"{FASTAPI_URL}/chat/stream",
+                        json={"chat_id": st.session_state.chat_id, "message": prompt},
+                        stream=True,
+                        timeout=DEFAULT_TIMEOUT
                     )
                     response.raise_for_status()
-                    assistant_response = response.json()
+                    tokens = stream_chat_answer(response, stream_state)
+                    first_token = next(tokens, None)
+
+                answer = st.write_stream(chain([first_token], tokens) if first_token is not None else tokens)
 
+                if stream_state["error"]:
+                    st.error(f"Failed to get response: {stream_state['error']}")
+                else:
                     message_data = {
                         "role": "assistant",
-                        "content": assistant_response["answer"],
-                        "sources": assistant_response["sources"],
+                        "content": answer,
+                        "sources": stream_state["sources"],
+                        "_sources_md": format_sources_md(stream_state["sources"]),
                     }
                     st.session_state.messages.append(message_data)
 
-                    display_assistant_message(message_data)
+                    display_sources(message_data["_sources_md"])
 
-                except requests.exceptions.RequestException as e:
-                    error_detail = "Could not connect to the backend."
-                    if e.response:
-                         error_detail = e.response.json().get('detail', 'Unknown error from server.')
-                    st.error(f"Failed to get response: {error_detail}")
\ No newline at end of file
+            except requests.exceptions.RequestException as e:
+                error_detail = "Could not connect to the backend."
+                if e.response:
+                     error_detail = e.response.json().get('detail', 'Unknown error from server.')
+                st.error(f"Failed to get response: {error_detail}")
\ No newline at end of file
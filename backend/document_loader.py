@@ -0,0 +1,74 @@
+import csv
+import os
+import fitz
+from typing import Iterator, List, Tuple
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from transformers import AutoTokenizer
+
+# This module runs inside worker processes, so it must stay free of model imports (tokenizers are fine).
+
+# Chunks are measured in tokens of the embedding model, so each one fits its 512-token window.
+TOKENIZER_NAME = "BAAI/bge-base-en-v1.5"
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 60
+# Text is fed to the splitter whenever this many characters (several chunks' worth) have accumulated,
+# instead of materializing whole documents.
+SPLIT_FLUSH_CHARS = 8000
+SUPPORTED_EXTENSIONS = {".pdf", ".txt", ".csv"}
+
+_text_splitter = None
+
+def _get_text_splitter() -> RecursiveCharacterTextSplitter:
+    global _text_splitter
+    if _text_splitter is None:
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, use_fast=True)
+        _text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+        )
+    return _text_splitter
+
+def init_worker():
+    # Worker-process initializer: load the tokenizer-backed splitter once, up front.
+    _get_text_splitter()
+
+def _extract_text(file_path: str, file_extension: str) -> Iterator[str]:
+    if file_extension == ".pdf":
+        with fitz.open(file_path) as doc:
+            for page in doc:
+                yield page.get_text("text")
+    elif file_extension == ".txt":
+        with open(file_path, 'r', encoding='utf-8') as f:
+            yield from iter(lambda: f.read(SPLIT_FLUSH_CHARS), '')
+    elif file_extension == ".csv":
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                yield ", ".join(row) + "\n"
+
+def extract_and_split(file_path: str, original_filename: str, prefix_chars: int) -> Tuple[str, List[str]]:
+    # Returns the first `prefix_chars` characters of the file's text (for classification) and its chunks.
+    file_extension = os.path.splitext(original_filename)[1].lower()
+    if file_extension not in SUPPORTED_EXTENSIONS:
+        return "", []
+
+    text_splitter = _get_text_splitter()
+    prefix, buffer, chunks = "", "", []
+    try:
+        for segment in _extract_text(file_path, file_extension):
+            if len(prefix) < prefix_chars:
+                prefix += segment[:prefix_chars - len(prefix)]
+            buffer += segment
+            if len(buffer) >= SPLIT_FLUSH_CHARS:
+                # The last chunk may continue into the next segment, so it is carried over and re-split.
+                # Carry the raw tail of the buffer from where that chunk starts: the splitter strips
+                # chunks, and dropping the trailing newline would glue rows and pages together.
+                buffer_chunks = text_splitter.split_text(buffer)
+                if buffer_chunks:
+                    chunks.extend(buffer_chunks[:-1])
+                    buffer = buffer[buffer.rfind(buffer_chunks[-1]):]
+                else:
+                    buffer = ""
+    except Exception as e: raise ValueError(f"Could not read file {original_filename}. Error: {e}")
+
+    if buffer.strip():
+        chunks.extend(text_splitter.split_text(buffer))
+    return prefix, chunks
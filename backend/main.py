@@ -1,38 +1,68 @@
 import os
 import uuid
-import sqlite3
 import json
 import logging
+import asyncio
+from functools import partial
+import aiofiles
+import aiosqlite
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 
 from rag_handler import (
     process_documents_and_create_collection,
     query_rag_pipeline,
+    stream_rag_pipeline,
+    clear_llm_caches,
     chroma_client
 )
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 os.makedirs("documents", exist_ok=True)
 os.makedirs("chroma_db", exist_ok=True)
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:8501"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
 DB_NAME = "chat_history.db"
-
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
+# One connection for the app's lifetime, opened in `lifespan`. aiosqlite runs it on its own thread and
+# queues statements; writes go through `db_write`, which holds DB_WRITE_LOCK so their transactions don't interleave.
+DB: Optional[aiosqlite.Connection] = None
+DB_WRITE_LOCK = asyncio.Lock()
+
+# Uploads are copied to disk in pieces of this size so a large file is never held in memory whole.
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+# Ingestion and the RAG pipeline are CPU-bound and blocking; they run here so the event loop stays free.
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+async def open_db() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_NAME)
+    # Under WAL with synchronous=NORMAL a commit is an append to the log without an fsync, which keeps
+    # per-message commits cheap; the database stays consistent after a crash, only the last commits may be lost.
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    return db
+
+@asynccontextmanager
+async def db_write():
+    # Serializes writers and commits on success. On any failure the open transaction is rolled back, so a
+    # half-written turn is never committed by the next writer sharing this connection.
+    async with DB_WRITE_LOCK:
+        try:
+            yield DB
+            await DB.commit()
+        except BaseException:
+            await DB.rollback()
+            raise
+
+async def init_db():
+    # chat_histories holds session metadata; its legacy `history` column is kept empty.
+    await DB.execute("""
         CREATE TABLE IF NOT EXISTS chat_histories (
             chat_id TEXT PRIMARY KEY,
             filenames TEXT,
@@ -40,11 +70,75 @@ def init_db():
             history TEXT
         )
     """)
-    conn.commit()
-    conn.close()
+    # Messages are appended one row each instead of rewriting a JSON blob of the whole conversation.
+    await DB.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            sources TEXT,
+            PRIMARY KEY (chat_id, idx)
+        )
+    """)
+
+    # Move histories written by older versions into the messages table.
+    async with DB.execute("SELECT chat_id, history FROM chat_histories WHERE history IS NOT NULL AND history != '[]'") as cursor:
+        legacy_histories = await cursor.fetchall()
+    for chat_id, history in legacy_histories:
+        await DB.executemany(
+            "INSERT OR IGNORE INTO messages (chat_id, idx, role, content, sources) VALUES (?, ?, ?, ?, ?)",
+            [
+                (chat_id, idx, message["role"], message["content"], json.dumps(message["sources"]) if "sources" in message else None)
+                for idx, message in enumerate(json.loads(history))
+            ]
+        )
+        await DB.execute("UPDATE chat_histories SET history = ? WHERE chat_id = ?", (json.dumps([]), chat_id))
+    await DB.commit()
+    if legacy_histories:
+        logging.info(f"Migrated {len(legacy_histories)} chat histories to the messages table.")
     logging.info("SQLite database initialized.")
 
-init_db()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global DB
+    DB = await open_db()
+    await init_db()
+    yield
+    await DB.close()
+    EXECUTOR.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:8501"], 
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXECUTOR, partial(func, *args, **kwargs))
+
+async def append_to_history(chat_id: str, user_message: str, response_data: Dict[str, Any]):
+    # Holding the write lock across the read and the inserts keeps concurrent turns from claiming the same idx.
+    async with db_write():
+        async with DB.execute("SELECT COALESCE(MAX(idx), -1) + 1 FROM messages WHERE chat_id = ?", (chat_id,)) as cursor:
+            (next_idx,) = await cursor.fetchone()
+        await DB.executemany(
+            "INSERT INTO messages (chat_id, idx, role, content, sources) VALUES (?, ?, ?, ?, ?)",
+            [
+                (chat_id, next_idx, "user", user_message, None),
+                (chat_id, next_idx + 1, "assistant", response_data["answer"], json.dumps(response_data["sources"])),
+            ]
+        )
+
+async def get_chat_role(chat_id: str) -> Optional[str]:
+    async with DB.execute("SELECT role FROM chat_histories WHERE chat_id = ?", (chat_id,)) as cursor:
+        result = await cursor.fetchone()
+    return result[0] if result else None
 
 class ChatMessage(BaseModel):
     chat_id: str; message: str
@@ -69,21 +163,19 @@ async def upload_documents(role: str = Form(...), files: List[UploadFile] = File
         for file in files:
             unique_filename = f"{chat_id}_{file.filename}"
             file_path = os.path.join("documents", unique_filename)
-            with open(file_path, "wb") as buffer:
-                buffer.write(await file.read())
             saved_files.append(file_path)
+            async with aiofiles.open(file_path, "wb") as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                    await buffer.write(chunk)
             filenames.append(file.filename)
 
-        process_documents_and_create_collection(files=saved_files, collection_name=chat_id)
+        await run_blocking(process_documents_and_create_collection, files=saved_files, collection_name=chat_id)
 
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO chat_histories (chat_id, filenames, role, history) VALUES (?, ?, ?, ?)",
-            (chat_id, json.dumps(filenames), role, json.dumps([]))
-        )
-        conn.commit()
-        conn.close()
+        async with db_write():
+            await DB.execute(
+                "INSERT INTO chat_histories (chat_id, filenames, role, history) VALUES (?, ?, ?, ?)",
+                (chat_id, json.dumps(filenames), role, json.dumps([]))
+            )
         return {"chat_id": chat_id, "filenames": filenames, "role": role}
     except Exception as e:
         logging.error(f"Upload failed: {e}", exc_info=True)
@@ -93,58 +185,71 @@ async def upload_documents(role: str = Form(...), files: List[UploadFile] = File
 
 @app.get("/chats", response_model=List[ChatSessionMetadata])
 async def get_all_chat_sessions():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT chat_id, filenames, role FROM chat_histories ORDER BY rowid DESC")
-    results = cursor.fetchall()
-    conn.close()
+    async with DB.execute("SELECT chat_id, filenames, role FROM chat_histories ORDER BY rowid DESC") as cursor:
+        results = await cursor.fetchall()
     return [{"chat_id": cid, "filenames": json.loads(fnames or '[]'), "role": r} for cid, fnames, r in results if r]
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat_with_document(request: ChatMessage):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT history, role FROM chat_histories WHERE chat_id = ?", (request.chat_id,))
-    result = cursor.fetchone()
-    if not result:
-        conn.close()
+    role = await get_chat_role(request.chat_id)
+    if role is None:
         raise HTTPException(status_code=404, detail="Chat session not found.")
-    current_history, role = json.loads(result[0]), result[1]
 
     try:
-        response_data = query_rag_pipeline(
+        response_data = await run_blocking(
+            query_rag_pipeline,
             question=request.message,
             collection_name=request.chat_id,
-            role=role,
-            chat_history=current_history
+            role=role
         )
-
-        history_entry = {
-            "role": "assistant",
-            "content": response_data["answer"],
-            "sources": response_data["sources"],
-        }
-
-        current_history.append({"role": "user", "content": request.message})
-        current_history.append(history_entry)
-
-        cursor.execute("UPDATE chat_histories SET history = ? WHERE chat_id = ?", (json.dumps(current_history), request.chat_id))
-        conn.commit()
-
+        await append_to_history(request.chat_id, request.message, response_data)
         return ChatResponse(**response_data)
 
     except Exception as e:
         logging.error(f"Chat processing failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An error occurred while processing your request.")
-    finally:
-        conn.close()
+
+@app.post("/chat/stream")
+async def chat_with_document_stream(request: ChatMessage):
+    role = await get_chat_role(request.chat_id)
+    if role is None:
+        raise HTTPException(status_code=404, detail="Chat session not found.")
+
+    async def event_stream():
+        events = stream_rag_pipeline(question=request.message, collection_name=request.chat_id, role=role)
+        # `sources` is the pipeline's last event, so it stays None unless the answer was generated in full.
+        answer_parts, sources = [], None
+        try:
+            async for event in iterate_in_threadpool(events):
+                if "token" in event: answer_parts.append(event["token"])
+                if "sources" in event: sources = event["sources"]
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            logging.error(f"Chat streaming failed: {e}", exc_info=True)
+            yield f"data: {json.dumps({'error': 'An error occurred while processing your request.'})}\n\n"
+        finally:
+            # Closing the generator releases the LLM lock if the client disconnected mid-answer. Only complete
+            # answers are saved; the shield keeps that write from being cancelled along with the response.
+            events.close()
+            if answer_parts and sources is not None:
+                await asyncio.shield(append_to_history(request.chat_id, request.message, {"answer": "".join(answer_parts), "sources": sources}))
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.get("/history/{chat_id}", response_model=List[dict])
 async def get_chat_history(chat_id: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT history FROM chat_histories WHERE chat_id = ?", (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if not result: raise HTTPException(status_code=404, detail="Chat history not found.")
-    return json.loads(result[0])
\ No newline at end of file
+    async with DB.execute("SELECT role, content, sources FROM messages WHERE chat_id = ? ORDER BY idx", (chat_id,)) as cursor:
+        rows = await cursor.fetchall()
+    if not rows:
+        async with DB.execute("SELECT 1 FROM chat_histories WHERE chat_id = ?", (chat_id,)) as cursor:
+            if not await cursor.fetchone(): raise HTTPException(status_code=404, detail="Chat history not found.")
+    return [
+        {"role": role, "content": content, "sources": json.loads(sources)} if sources is not None
+        else {"role": role, "content": content}
+        for role, content, sources in rows
+    ]
+
+@app.post("/admin/clear-caches")
+async def clear_caches():
+    clear_llm_caches()
+    return {"status": "cleared"}
\ No newline at end of file
@@ -0,0 +1,38 @@
+import numpy as np
+from typing import List, Union
+from transformers import AutoTokenizer
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+class OnnxEmbedder:
+    # Drop-in replacement for the SentenceTransformer.encode calls in rag_handler, running an
+    # INT8-quantized ONNX export of BGE on ONNX Runtime's CPU provider.
+    def __init__(self, model_dir: str, file_name: str, tokenizer_name: str, max_length: int = 512):
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=file_name, provider="CPUExecutionProvider"
+        )
+        self.max_length = max_length
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, normalize_embeddings: bool = False,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            outputs = self.model(**inputs)
+            # BGE is trained with CLS pooling, which is what its SentenceTransformer config uses too.
+            batches.append(np.asarray(outputs.last_hidden_state[:, 0], dtype=np.float32))
+        embeddings = np.concatenate(batches)
+
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
@@ -1,26 +1,90 @@
 import torch
 import logging
 import chromadb
-import fitz  
-import csv
+import hashlib
+import diskcache
 from sentence_transformers import SentenceTransformer, CrossEncoder
-from llama_cpp import Llama
+from llama_cpp import Llama, LlamaRAMCache
 from huggingface_hub import hf_hub_download
 import json
+import numpy as np
 import os
-from typing import List, Dict, Any
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import uuid
+import threading
+import multiprocessing
+from collections import OrderedDict
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from document_loader import extract_and_split, init_worker
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# --- Compute settings: use every CPU core for torch and the Rust tokenizers, FP16 on CUDA ---
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+torch.set_num_threads(os.cpu_count() or 1)
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_MODEL_NAME = "BAAI/bge-base-en-v1.5"
+# Optional INT8 ONNX export of the embedding model (see README); used on CPU when present.
+EMBEDDING_ONNX_DIR = os.environ.get("EMBEDDING_ONNX_DIR", "./bge-onnx-int8")
+EMBEDDING_ONNX_FILE = "model_quantized.onnx"
+RERANK_BATCH_SIZE = 16
+# The cross-encoder is skipped when first-stage retrieval is already decisive: a close top hit that
+# is well separated from the 4th (cosine distances).
+RERANK_SKIP_MAX_TOP_DISTANCE = 0.25
+RERANK_SKIP_MIN_MARGIN = 0.15
+# Rows per collection.add call, so large uploads are not written as one giant transaction.
+CHROMA_ADD_BATCH_SIZE = 5000
+# Prompt KV states kept in RAM so requests sharing a prompt prefix skip re-processing it.
+LLM_PROMPT_CACHE_BYTES = 2 << 30
+
+# --- Document classification: FinBERT sees at most 512 tokens, which this many characters comfortably covers ---
+CLASSIFICATION_PREFIX_CHARS = 2000
+CLASSIFICATION_CACHE_DIR = "./classification_cache"
+
+# --- Chroma HNSW index settings. Embeddings are L2-normalized, so cosine is the matching space.
+# These are fixed when a collection is created; changing space, M or construction_ef only affects
+# collections built afterwards, so existing chats must be re-uploaded to pick them up.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+    "hnsw:M": 16
+}
+
+# --- Semantic answer cache: a question within this cosine distance of a cached one reuses its answer ---
+SEMANTIC_CACHE_MAX_DISTANCE = 0.05
+
 # --- MODEL AND CLIENT INITIALIZATION ---
 llm = None
 embedding_model = None
 classification_pipeline = None
+classification_cache = None
 ner_pipeline = None
 chroma_client = None
 reranker_model = None
 
+# A llama.cpp context is not thread-safe; pipeline calls run in a thread pool, so serialize access to it.
+LLM_LOCK = threading.Lock()
+# Uploads run concurrently, so the lazily built FinBERT pipeline and its disk cache are created under a lock.
+classification_init_lock = threading.Lock()
+# Runs first-stage retrieval while the LLM router is busy.
+RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Text extraction workers live for the whole process so each loads the splitter's tokenizer only once.
+# They start from a forkserver (spawn where unavailable) rather than forking this process, which holds
+# the mlocked LLM and torch/executor threads; document_loader keeps their imports light.
+EXTRACTION_WORKERS = min(4, os.cpu_count() or 1)
+extraction_pool = None
+extraction_pool_lock = threading.Lock()
+
+# Counts reranks skipped versus attempted, logged to tune the skip thresholds. Pipeline calls run on
+# several threads, so the counters are only updated under rerank_stats_lock.
+rerank_stats = {"skipped": 0, "total": 0}
+rerank_stats_lock = threading.Lock()
+
 # --- Detailed, one-time role descriptions for the LLM Router ---
 ROLE_DESCRIPTIONS = {
     "Product Lead": "Focuses on product features, business strategy, user experience, market requirements, user limits, transaction rules, and delegation of product-related authority. They are concerned with the 'what' and 'why' of the product.",
@@ -29,6 +93,21 @@ ROLE_DESCRIPTIONS = {
     "Bank Alliance Lead": "Focuses on relationships with partner banks, partnership agreements, Service Level Agreements (SLAs), and the business/technical integration with financial partners."
 }
 
+# --- Prompts, built once so every request shares a byte-identical prefix (reused by the llama.cpp prompt cache) ---
+ROLE_DESC_BLOCK = "\n".join(f"- {role}: {description}" for role, description in ROLE_DESCRIPTIONS.items())
+# The session role is given only for the rewrite and comes after the question, so the classification
+# stays independent of it, as it was when routing was a separate call.
+_ROUTER_SYSTEM_MESSAGE = {"role": "system", "content": "You are an expert dispatcher and query rewriter. First, identify the SINGLE most relevant role for the user's question from the list, judging from the question alone; the user's own role must NOT influence predicted_role. Then rewrite the user's query to be specific to the user's role, making it ideal for a semantic database search. Respond with ONLY compact JSON: {\"predicted_role\": \"<role title>\", \"rewritten_query\": \"<rewritten query>\"}"}
+_ROUTER_USER_TMPL = f"Role Descriptions:\n{ROLE_DESC_BLOCK}\n\nUser's Question: \"{{question}}\"\n\nUser's Role (use ONLY for rewritten_query, not for predicted_role): {{role}}"
+
+_ANSWER_SYSTEM_TMPL = """You are a precise, factual assistant acting as a {role}. Your task is to answer the user's question based *only* on the provided context. Follow these rules strictly:
+1.  **Reasoning for 'What If':** If the user asks a hypothetical 'what if' question, use the facts from the context to reason about the scenario and provide a step-by-step explanation for your conclusion.
+2.  **Be Direct:** For factual questions, directly answer the question. Do not provide long explanations or summarize the entire source document.
+3.  **Use Formatting:** Structure your answer with bullet points (*) and bold text (**) to highlight key information.
+4.  **Stay in Context:** If the answer is not in the provided context, you must respond with "Based on the provided documents, I cannot answer that question."
+"""
+_ANSWER_USER_TMPL = "CONTEXT SNIPPETS:\n---\n{context}\n---\n\nQUESTION: \"{question}\"\n\nANSWER:"
+
 try:
     # Using the Llama 3 8B model from QuantFactory
     logging.info("Initializing Llama 3 8B LLM from QuantFactory. This may trigger a one-time download (~4.7 GB)...")
@@ -42,16 +121,30 @@ try:
         model_path=model_path,
         n_gpu_layers=0,      # Force CPU
         n_ctx=8192,          # Context window size
+        n_batch=512,         # Prompt tokens processed per batch
+        n_threads=os.cpu_count(),
+        n_threads_batch=os.cpu_count(),
+        use_mlock=True,      # Keep the weights resident in RAM
         chat_format="llama-3" # Use the built-in chat format for Llama 3
     )
+    llm.set_cache(LlamaRAMCache(capacity_bytes=LLM_PROMPT_CACHE_BYTES))
     logging.info("Llama 3 8B LLM initialized successfully.")
     
     # --- Other models are initialized as before ---
     logging.info("Initializing Reranker model (cross-encoder/ms-marco-MiniLM-L-6-v2)...")
-    reranker_model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2', max_length=512)
+    reranker_model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2', max_length=512, device=DEVICE)
+    if DEVICE == "cuda":
+        reranker_model.model.half()
 
     logging.info("Initializing Embedding model (BAAI/bge-base-en-v1.5)...")
-    embedding_model = SentenceTransformer('BAAI/bge-base-en-v1.5')
+    if DEVICE == "cpu" and os.path.exists(os.path.join(EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_FILE)):
+        from onnx_embedder import OnnxEmbedder
+        logging.info(f"Using INT8 ONNX Runtime embeddings from {EMBEDDING_ONNX_DIR}.")
+        embedding_model = OnnxEmbedder(EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_FILE, EMBEDDING_MODEL_NAME)
+    else:
+        embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=DEVICE)
+        if DEVICE == "cuda":
+            embedding_model.half()
 
     logging.info("Initializing ChromaDB client...")
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
@@ -63,134 +156,302 @@ except Exception as e:
     exit()
 
 
-def check_relevance_with_llm(question: str, current_role: str) -> Dict[str, Any]:
-    if current_role not in ROLE_DESCRIPTIONS:
-        return {"is_relevant": True, "reason": "Role not found."}
+def _normalize_question(question: str) -> str:
+    return question.strip().lower()
 
+# Router and rewriter prompts run at temperature 0.0, so their output is a pure function of the inputs.
+# Results are cached under the normalized question to raise the hit rate, while the LLM sees the original
+# text (acronyms like KYC or UPI keep their case). Least recently used entries are evicted past the limit.
+ROUTER_CACHE_MAX_ENTRIES = 2048
+_router_cache: "OrderedDict[Tuple[str, str], Tuple[str, str]]" = OrderedDict()
+_router_cache_lock = threading.Lock()
+
+def _classify_and_rewrite(question: str, role: str) -> Tuple[str, str]:
     messages = [
-        {"role": "system", "content": "You are an expert dispatcher. Your task is to identify the SINGLE most relevant role for the user's question from the list. Respond with only the role title."},
-        {"role": "user", "content": f"Role Descriptions:\n- Product Lead: {ROLE_DESCRIPTIONS['Product Lead']}\n- Tech Lead: {ROLE_DESCRIPTIONS['Tech Lead']}\n- Compliance Lead: {ROLE_DESCRIPTIONS['Compliance Lead']}\n- Bank Alliance Lead: {ROLE_DESCRIPTIONS['Bank Alliance Lead']}\n\nUser's Question: \"{question}\"\n\nBased on the question, which role is most relevant?"}
+        _ROUTER_SYSTEM_MESSAGE,
+        {"role": "user", "content": _ROUTER_USER_TMPL.format(role=role, question=question)}
     ]
-    
-    response = llm.create_chat_completion(messages=messages, max_tokens=20, temperature=0.0)
-    predicted_role = response['choices'][0]['message']['content'].strip()
-    
+
+    # max_tokens leaves room for a long rewritten query; a truncated reply would not parse.
+    with LLM_LOCK:
+        response = llm.create_chat_completion(messages=messages, response_format={"type": "json_object"}, max_tokens=256, temperature=0.0)
+    content = response['choices'][0]['message']['content']
+    # Raising (rather than returning a fallback) keeps the unusable reply out of the router cache.
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"LLM router returned invalid JSON: {content!r}") from e
+    if not isinstance(parsed, dict):
+        raise ValueError(f"LLM router returned JSON that is not an object: {content!r}")
+    predicted_role = str(parsed.get("predicted_role", "")).strip()
+    rewritten_query = str(parsed.get("rewritten_query", "")).strip().replace('"', '')
+    return predicted_role, rewritten_query or question
+
+def _classify_and_rewrite_cached(question: str, role: str) -> Tuple[str, str]:
+    key = (_normalize_question(question), role)
+    with _router_cache_lock:
+        if key in _router_cache:
+            _router_cache.move_to_end(key)
+            return _router_cache[key]
+
+    result = _classify_and_rewrite(question, role)
+    with _router_cache_lock:
+        _router_cache[key] = result
+        while len(_router_cache) > ROUTER_CACHE_MAX_ENTRIES:
+            _router_cache.popitem(last=False)
+    return result
+
+def route_and_rewrite_query(question: str, current_role: str) -> Dict[str, Any]:
+    logging.info(f"Original query: '{question}'")
+    try:
+        predicted_role, rewritten_query = _classify_and_rewrite_cached(question, current_role)
+    except ValueError as e:
+        # An unreadable router reply is not cached; the original question stands in for the rewrite.
+        logging.warning(f"{e}; falling back to the original question.")
+        predicted_role, rewritten_query = None, question
     logging.info(f"LLM Router classified question for role: '{predicted_role}'")
 
-    if predicted_role == current_role:
-        return {"is_relevant": True}
+    if current_role not in ROLE_DESCRIPTIONS or predicted_role == current_role:
+        logging.info(f"Rewritten query for retrieval: '{rewritten_query}'")
+        return {"is_relevant": True, "rewritten_query": rewritten_query}
+    elif predicted_role is None:
+        return {"is_relevant": False, "reason": "Could not classify the question, please retry."}
     else:
         reason = f"This question seems outside the scope of a {current_role}."
         if predicted_role in ROLE_DESCRIPTIONS:
             reason += f" It seems better suited for a **{predicted_role}**."
         return {"is_relevant": False, "reason": reason}
 
-def rewrite_query_for_role(question: str, role: str) -> str:
-    logging.info(f"Original query: '{question}'")
-    messages = [
-        {"role": "system", "content": "You are an expert query rewriter. Your task is to rewrite the user's query to be specific to their professional role, making it ideal for a semantic database search. Respond with ONLY the rewritten query text and nothing else."},
-        {"role": "user", "content": f"User's Role: {role}\nOriginal Question: \"{question}\"\n\nRewritten Query:"}
-    ]
-    
-    response = llm.create_chat_completion(messages=messages, max_tokens=100, temperature=0.0)
-    rewritten_query = response['choices'][0]['message']['content'].strip().replace('"', '')
-    logging.info(f"Rewritten query for retrieval: '{rewritten_query}'")
-    return rewritten_query
+def _cache_collection_name(collection_name: str) -> str:
+    return f"cache_{collection_name}"
 
-def query_rag_pipeline(question: str, collection_name: str, role: str, chat_history: List[Dict]) -> Dict[str, Any]:
-    if not all([llm, embedding_model, chroma_client, reranker_model]):
-        raise ConnectionError("Core models not initialized.")
+def clear_llm_caches():
+    with _router_cache_lock:
+        _router_cache.clear()
+    # Stored answers are LLM output too; their collections are recreated empty on the next question.
+    dropped = 0
+    if chroma_client is not None:
+        for collection in chroma_client.list_collections():
+            # Older chromadb releases return Collection objects, newer ones return names.
+            name = getattr(collection, "name", collection)
+            if name.startswith(_cache_collection_name("")):
+                chroma_client.delete_collection(name=name)
+                dropped += 1
+    logging.info(f"Cleared LLM router and rewriter caches and {dropped} semantic answer caches.")
 
-    relevance_check = check_relevance_with_llm(question, role)
-    if not relevance_check["is_relevant"]:
-        return {"answer": relevance_check["reason"], "sources": []}
+def _lookup_cached_answer(cache_collection, question_embedding: List[float]) -> Optional[Dict[str, Any]]:
+    if cache_collection.count() == 0:
+        return None
+    hits = cache_collection.query(query_embeddings=[question_embedding], n_results=1, include=['metadatas', 'distances'])
+    if not hits['ids'][0] or hits['distances'][0][0] >= SEMANTIC_CACHE_MAX_DISTANCE:
+        return None
+    logging.info(f"Semantic cache hit (distance {hits['distances'][0][0]:.4f}).")
+    return json.loads(hits['metadatas'][0][0]['payload'])
 
-    enhanced_query = rewrite_query_for_role(question, role)
+def _store_cached_answer(cache_collection, question_embedding: List[float], response: Dict[str, Any]):
+    try:
+        cache_collection.add(
+            embeddings=[question_embedding],
+            metadatas=[{'payload': json.dumps(response)}],
+            ids=[uuid.uuid4().hex]
+        )
+    except Exception as e:
+        # The collection may have been dropped by clear_llm_caches while the answer was generated.
+        logging.warning(f"Could not store the answer in the semantic cache: {e}")
 
+def _retrieve_context(question_embedding: List[float], collection_name: str) -> Tuple[List[str], List[Dict], List[float]]:
     collection = chroma_client.get_collection(name=collection_name)
-    question_embedding = embedding_model.encode(enhanced_query).tolist()
-    
     results = collection.query(
         query_embeddings=[question_embedding],
         n_results=10,
-        include=['documents', 'metadatas']
+        include=['documents', 'metadatas', 'distances']
     )
-    
-    retrieved_docs = results['documents'][0] if results['documents'] else []
+    if not results['documents'] or not results['documents'][0]:
+        return [], [], []
+    return results['documents'][0], results['metadatas'][0], results['distances'][0]
+
+def _is_retrieval_decisive(distances: List[float]) -> bool:
+    return (
+        len(distances) >= 4
+        and distances[0] < RERANK_SKIP_MAX_TOP_DISTANCE
+        and distances[3] - distances[0] > RERANK_SKIP_MIN_MARGIN
+    )
+
+def _prepare_generation(question: str, collection_name: str, role: str) -> Dict[str, Any]:
+    # Returns {"response": ...} when the pipeline can answer without generation,
+    # otherwise the chat messages for the final LLM call plus everything needed to finish the answer.
+    if not all([llm, embedding_model, chroma_client, reranker_model]):
+        raise ConnectionError("Core models not initialized.")
+
+    cache_collection = chroma_client.get_or_create_collection(
+        name=_cache_collection_name(collection_name), metadata=HNSW_METADATA
+    )
+    question_embedding = embedding_model.encode(question, normalize_embeddings=True).tolist()
+    cached_response = _lookup_cached_answer(cache_collection, question_embedding)
+    if cached_response is not None:
+        return {"response": cached_response}
+
+    # Retrieval only needs the question embedding, so it runs while the LLM routes and rewrites the query;
+    # the rewritten query then drives reranking.
+    retrieval = RETRIEVAL_EXECUTOR.submit(_retrieve_context, question_embedding, collection_name)
+    routing = route_and_rewrite_query(question, role)
+    if not routing["is_relevant"]:
+        retrieval.cancel()
+        return {"response": {"answer": routing["reason"], "sources": []}}
+
+    enhanced_query = routing["rewritten_query"]
+    retrieved_docs, retrieved_metadatas, retrieved_distances = retrieval.result()
     if not retrieved_docs:
-        return {"answer": "I could not find relevant information in the uploaded documents to answer your question.", "sources": []}
+        return {"response": {"answer": "I could not find relevant information in the uploaded documents to answer your question.", "sources": []}}
 
-    rerank_pairs = [[enhanced_query, doc] for doc in retrieved_docs]
-    rerank_scores = reranker_model.predict(rerank_pairs)
-    reranked_results = sorted(zip(rerank_scores, results['metadatas'][0], retrieved_docs), reverse=True)
-    final_metadatas = [meta for score, meta, doc in reranked_results[:4]]
-    final_docs = [doc for score, meta, doc in reranked_results[:4]]
+    skip_rerank = _is_retrieval_decisive(retrieved_distances)
+    with rerank_stats_lock:
+        rerank_stats["total"] += 1
+        rerank_stats["skipped"] += int(skip_rerank)
+        skipped, total = rerank_stats["skipped"], rerank_stats["total"]
+    logging.info(f"{'Skipping rerank, retrieval is decisive' if skip_rerank else 'Reranking retrieved chunks'} (skip rate {skipped}/{total}).")
+    if skip_rerank:
+        final_metadatas, final_docs = retrieved_metadatas[:4], retrieved_docs[:4]
+    else:
+        rerank_pairs = [[enhanced_query, doc] for doc in retrieved_docs]
+        rerank_scores = reranker_model.predict(
+            rerank_pairs, batch_size=RERANK_BATCH_SIZE, convert_to_numpy=True, show_progress_bar=False
+        )
+        reranked_results = sorted(zip(rerank_scores, retrieved_metadatas, retrieved_docs), key=lambda result: result[0], reverse=True)
+        final_metadatas = [meta for score, meta, doc in reranked_results[:4]]
+        final_docs = [doc for score, meta, doc in reranked_results[:4]]
 
     context_parts = []
     for meta, doc in zip(final_metadatas, final_docs):
         context_parts.append(f"Source Document: '{meta['source_file']}'\nContent Snippet: {doc}")
     context = "\n---\n".join(context_parts)
 
-    system_prompt = f"""You are a precise, factual assistant acting as a {role}. Your task is to answer the user's question based *only* on the provided context. Follow these rules strictly:
-1.  **Reasoning for 'What If':** If the user asks a hypothetical 'what if' question, use the facts from the context to reason about the scenario and provide a step-by-step explanation for your conclusion.
-2.  **Be Direct:** For factual questions, directly answer the question. Do not provide long explanations or summarize the entire source document.
-3.  **Use Formatting:** Structure your answer with bullet points (*) and bold text (**) to highlight key information.
-4.  **Stay in Context:** If the answer is not in the provided context, you must respond with "Based on the provided documents, I cannot answer that question."
-"""
     messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"CONTEXT SNIPPETS:\n---\n{context}\n---\n\nQUESTION: \"{question}\"\n\nANSWER:"}
+        {"role": "system", "content": _ANSWER_SYSTEM_TMPL.format(role=role)},
+        {"role": "user", "content": _ANSWER_USER_TMPL.format(context=context, question=question)}
     ]
-    
-    response = llm.create_chat_completion(messages=messages, max_tokens=512, temperature=0.1)
+
+    # All chunks of a file share the same classification, so keeping one metadata entry per file loses nothing.
+    used_sources = [
+        {
+            'source_file': source['source_file'],
+            'doc_type': source.get('doc_type', 'N/A'),
+            'doc_type_score': source.get('doc_type_score')
+        }
+        for source in {meta['source_file']: meta for meta in final_metadatas}.values()
+    ]
+
+    return {
+        "messages": messages,
+        "sources": used_sources,
+        "cache_collection": cache_collection,
+        "cache_embedding": question_embedding
+    }
+
+def query_rag_pipeline(question: str, collection_name: str, role: str, chat_history: Optional[List[Dict]] = None) -> Dict[str, Any]:
+    prepared = _prepare_generation(question, collection_name, role)
+    if "response" in prepared:
+        return prepared["response"]
+
+    with LLM_LOCK:
+        response = llm.create_chat_completion(messages=prepared["messages"], max_tokens=512, temperature=0.1)
     answer = response['choices'][0]['message']['content']
 
-    used_sources = []
-    seen_files = set()
-    for source in final_metadatas:
-        if source['source_file'] not in seen_files:
-            used_sources.append({
-                'source_file': source['source_file'],
-                'doc_type': source.get('doc_type', 'N/A'),
-                'doc_type_score': source.get('doc_type_score')
-            })
-            seen_files.add(source['source_file'])
+    response_data = {"answer": answer, "sources": prepared["sources"]}
+    _store_cached_answer(prepared["cache_collection"], prepared["cache_embedding"], response_data)
+    return response_data
+
+def stream_rag_pipeline(question: str, collection_name: str, role: str) -> Iterator[Dict[str, Any]]:
+    # Yields {"token": ...} events while the answer is generated, then a final {"sources": ...} event.
+    prepared = _prepare_generation(question, collection_name, role)
+    if "response" in prepared:
+        yield {"token": prepared["response"]["answer"]}
+        yield {"sources": prepared["response"]["sources"]}
+        return
+
+    answer_parts = []
+    with LLM_LOCK:
+        for chunk in llm.create_chat_completion(messages=prepared["messages"], max_tokens=512, temperature=0.1, stream=True):
+            token = chunk['choices'][0]['delta'].get('content', '')
+            if token:
+                answer_parts.append(token)
+                yield {"token": token}
 
-    return {"answer": answer, "sources": used_sources}
+    response_data = {"answer": "".join(answer_parts), "sources": prepared["sources"]}
+    _store_cached_answer(prepared["cache_collection"], prepared["cache_embedding"], response_data)
+    yield {"sources": prepared["sources"]}
 
 
+# Results are also persisted on disk by prefix hash, so identical documents skip FinBERT across restarts.
+@lru_cache(maxsize=256)
+def _classify_cached(prefix_hash: str, prefix: str) -> Tuple[str, float]:
+    global classification_pipeline, classification_cache
+    with classification_init_lock:
+        if classification_cache is None:
+            classification_cache = diskcache.Cache(CLASSIFICATION_CACHE_DIR)
+    cached = classification_cache.get(prefix_hash)
+    if cached is not None:
+        return tuple(cached)
+
+    with classification_init_lock:
+        if classification_pipeline is None:
+            from transformers import pipeline
+            classification_pipeline = pipeline(
+                "text-classification",
+                model="ProsusAI/finbert",
+                truncation=True,
+                max_length=512,
+                device=0 if DEVICE == "cuda" else -1
+            )
+    result = classification_pipeline(prefix, top_k=1)[0]
+    label, score = result['label'], float(result['score'])
+    classification_cache.set(prefix_hash, (label, score))
+    return label, score
+
 def classify_document(text: str) -> Dict[str, Any]:
-    global classification_pipeline
-    if classification_pipeline is None:
-        from transformers import pipeline
-        classification_pipeline = pipeline("text-classification", model="ProsusAI/finbert")
-    result = classification_pipeline(text[:512], top_k=1)[0]
-    return {"label": result['label'], "score": float(result['score'])}
+    prefix = text[:CLASSIFICATION_PREFIX_CHARS]
+    prefix_hash = hashlib.sha1(prefix.encode('utf-8')).hexdigest()
+    label, score = _classify_cached(prefix_hash, prefix)
+    return {"label": label, "score": score}
+
+def _get_extraction_pool() -> ProcessPoolExecutor:
+    global extraction_pool
+    with extraction_pool_lock:
+        if extraction_pool is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            extraction_pool = ProcessPoolExecutor(
+                max_workers=EXTRACTION_WORKERS,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=init_worker
+            )
+        return extraction_pool
+
+def _reset_extraction_pool():
+    global extraction_pool
+    with extraction_pool_lock:
+        if extraction_pool is not None:
+            extraction_pool.shutdown(wait=False)
+        extraction_pool = None
 
 def process_documents_and_create_collection(files: list, collection_name: str):
     if not all([chroma_client, embedding_model]): raise ConnectionError("Core services not initialized.")
     all_chunks, all_metadatas, all_ids = [], [], []
-    doc_id_counter = 0
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-
-    for file_path in files:
-        original_filename = os.path.basename(file_path).split(f"{collection_name}_", 1)[1]
-        doc_id_counter += 1
-        text = ""
-        try:
-            file_extension = os.path.splitext(original_filename)[1].lower()
-            if file_extension == ".pdf":
-                with fitz.open(file_path) as doc: text = "".join(page.get_text("text") for page in doc)
-            elif file_extension == ".txt":
-                with open(file_path, 'r', encoding='utf-8') as f: text = f.read()
-            elif file_extension == ".csv":
-                with open(file_path, 'r', encoding='utf-8', newline='') as f: text = "\n".join([", ".join(row) for row in csv.reader(f)])
-            else: continue
-        except Exception as e: raise ValueError(f"Could not read file {original_filename}. Error: {e}")
-        if not text.strip(): continue
-
-        classification_result = classify_document(text)
-        chunks = text_splitter.split_text(text)
+    original_filenames = [os.path.basename(file_path).split(f"{collection_name}_", 1)[1] for file_path in files]
+
+    # Text extraction and splitting are CPU-bound and independent per file, so files are spread over worker processes.
+    try:
+        extracted = list(_get_extraction_pool().map(
+            partial(extract_and_split, prefix_chars=CLASSIFICATION_PREFIX_CHARS), files, original_filenames
+        ))
+    except BrokenProcessPool:
+        # A crashed worker breaks the whole pool; start a fresh one for the next upload.
+        _reset_extraction_pool()
+        raise
+
+    for doc_id_counter, (original_filename, (prefix, chunks)) in enumerate(zip(original_filenames, extracted), start=1):
+        if not chunks: continue
+
+        classification_result = classify_document(prefix)
         for chunk_idx, chunk in enumerate(chunks, start=1):
             chunk_id = f"doc{doc_id_counter}_chunk{chunk_idx}"
             all_chunks.append(chunk)
@@ -202,7 +463,26 @@ def process_documents_and_create_collection(files: list, collection_name: str):
             all_ids.append(chunk_id)
 
     if not all_chunks: raise ValueError("No text could be extracted from the provided documents.")
-    collection = chroma_client.get_or_create_collection(name=collection_name)
-    if collection.count() > 0: collection.delete(ids=collection.get(include=[])['ids'])
-    embeddings = embedding_model.encode(all_chunks, show_progress_bar=True).tolist()
-    collection.add(embeddings=embeddings, documents=all_chunks, metadatas=all_metadatas, ids=all_ids)
\ No newline at end of file
+    # Dropping and recreating the collection is O(1), unlike listing every id to delete it.
+    for stale_collection in (collection_name, _cache_collection_name(collection_name)):
+        try: chroma_client.delete_collection(name=stale_collection)
+        except Exception: pass  # Nothing to drop for a new chat.
+    collection = chroma_client.create_collection(name=collection_name, metadata=HNSW_METADATA)
+    embeddings = embedding_model.encode(
+        all_chunks,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False
+    )
+    # Chroma's HNSW index stores float32 vectors only (no int8 or binary storage, no hamming space), so
+    # quantizing here would save nothing; hand it float32 directly (the FP16 model on CUDA returns float16).
+    embeddings = embeddings.astype(np.float32, copy=False)
+    for start in range(0, len(all_chunks), CHROMA_ADD_BATCH_SIZE):
+        end = start + CHROMA_ADD_BATCH_SIZE
+        collection.add(
+            embeddings=embeddings[start:end],
+            documents=all_chunks[start:end],
+            metadatas=all_metadatas[start:end],
+            ids=all_ids[start:end]
+        )
\ No newline at end of file